@@ -2,9 +2,12 @@
 # Licensed under the MIT License.
 
 import argparse
+import gc
+import hashlib
 import os
 import sys
 import time
+import uuid
 import torch
 import torch.distributed as dist
 import torch.multiprocessing as mp
@@ -15,6 +18,7 @@ if nlp_path not in sys.path:
 
 sys.path.insert(0, "./")
 from utils_nlp.dataset.cnndm import CNNDMBertSumProcessedData, CNNDMSummarizationDataset
+from utils_nlp.models.transformers.bertsum.dataset import ExtSumEncodedDataset
 from utils_nlp.models.transformers.extractive_summarization import (
     ExtractiveSummarizer,
     ExtSumProcessedData,
@@ -24,7 +28,9 @@ from utils_nlp.models.transformers.extractive_summarization import (
 # os.environ["NCCL_BLOCKING_WAIT"] = "1"
 
 os.environ["NCCL_IB_DISABLE"] = "0"
-os.environ['OMP_NUM_THREADS'] = str(torch.cuda.device_count())
+# NCCL tuning knobs, which can be overridden from the environment
+os.environ.setdefault("NCCL_ALGO", "Ring,Tree")
+os.environ.setdefault("NCCL_NSOCKS_PERTHREAD", "4")
 os.environ["KMP_AFFINITY"] = "verbose"
 
 parser = argparse.ArgumentParser()
@@ -34,8 +40,22 @@ parser.add_argument(
 parser.add_argument(
     "--dist_url",
     type=str,
-    default="tcp://127.0.0.1:29501",
-    help="URL specifying how to initialize the process groupi.",
+    default="env://",
+    help="URL specifying how to initialize the process group. With the default \
+                        env://, the master node is read from MASTER_ADDR and \
+                        MASTER_PORT, which default to 127.0.0.1 and 29501.",
+)
+parser.add_argument(
+    "--nccl_socket_ifname",
+    type=str,
+    default=None,
+    help="Network interface(s) used by NCCL, e.g. ib0. Sets NCCL_SOCKET_IFNAME.",
+)
+parser.add_argument(
+    "--nccl_ib_hca",
+    type=str,
+    default=None,
+    help="InfiniBand adapter(s) used by NCCL, e.g. mlx5_0. Sets NCCL_IB_HCA.",
 )
 parser.add_argument(
     "--node_count", type=int, default=1, help="Number of nodes in the cluster."
@@ -86,11 +106,77 @@ parser.add_argument("--learning_rate", type=float, default=1e-3, help="Learning
 parser.add_argument(
     "--batch_size",
     type=int,
-    default=5,
-    help="batch size in terms of the number of samples in training",
+    default=None,
+    help="batch size in terms of the number of samples in training. Defaults to \
+                        5, or 32 if grad_checkpoint is set.",
     # default=3000,
     # help="batch size in terms of input token numbers in training",
 )
+parser.add_argument(
+    "--tokens_per_batch",
+    type=int,
+    default=None,
+    help="If set, e.g. to 3000, examples of similar lengths are batched together \
+                        with at most this number of input tokens per batch, and \
+                        batch_size is not used.",
+)
+parser.add_argument(
+    "--num_workers",
+    type=int,
+    default=2,
+    help="Number of data loader worker processes per GPU used to collate batches.",
+)
+parser.add_argument(
+    "--prefetch_factor",
+    type=int,
+    default=4,
+    help="Number of batches loaded in advance by each data loader worker.",
+)
+parser.add_argument(
+    "--persistent_workers",
+    type=str.lower,
+    default="true",
+    choices=["true", "false"],
+    help="Whether to keep the data loader workers alive between epochs.",
+)
+parser.add_argument(
+    "--precision",
+    type=str.lower,
+    default="fp32",
+    choices=["fp32", "fp16", "bf16"],
+    help="Precision of the forward pass in training.",
+)
+parser.add_argument(
+    "--grad_compression",
+    type=str.lower,
+    default="none",
+    choices=["none", "fp16", "powersgd"],
+    help="Compression of the gradients all-reduced across GPUs. Useful on \
+                        ethernet clusters, it should be disabled on InfiniBand.",
+)
+parser.add_argument(
+    "--compile",
+    type=str.lower,
+    default="false",
+    choices=["true", "false"],
+    help="Whether to compile the model with torch.compile.",
+)
+parser.add_argument(
+    "--grad_checkpoint",
+    type=str.lower,
+    default="false",
+    choices=["true", "false"],
+    help="Whether to recompute the transformer activations in the backward pass \
+                        to reduce memory usage and allow larger batches.",
+)
+parser.add_argument(
+    "--cuda_graphs",
+    type=str.lower,
+    default="false",
+    choices=["true", "false"],
+    help="Whether to replay the training steps with CUDA graphs. The batches are \
+                        padded to max_pos_length, tokens_per_batch can't be used.",
+)
 parser.add_argument(
     "--max_steps",
     type=int,
@@ -127,7 +213,8 @@ parser.add_argument(
     "--train_file",
     type=str,
     default=None,
-    help="training data file which is saved through torch",
+    help="training data file which is saved through torch. It's encoded once \
+                        into memory-mapped token ids cached in data_dir.",
 )
 parser.add_argument(
     "--test_file",
@@ -142,6 +229,55 @@ def cleanup():
     dist.destroy_process_group()
 
 
+def build_summarizer(args):
+    processor = ExtSumProcessor(model_name=args.model_name)
+    return ExtractiveSummarizer(
+        processor, args.model_name, args.encoder, args.max_pos_length, args.cache_dir
+    )
+
+
+def cpu_set_for_local_rank(local_rank, ngpus_per_node):
+    """ CPUs of the process of a GPU: the available CPUs are split into contiguous
+        chunks, which on common multi-socket servers keeps each process on the
+        NUMA node its GPU is attached to."""
+    cpus = sorted(os.sched_getaffinity(0))
+    chunk_size = max(1, len(cpus) // ngpus_per_node)
+    cpu_set = set(cpus[local_rank * chunk_size : (local_rank + 1) * chunk_size])
+    return cpu_set or set(cpus)
+
+
+def set_omp_num_threads(ngpus_per_node):
+    """ The CPU cores of a node are shared by the processes of its GPUs. Only the
+        cores this process may run on are counted, which in containers can be
+        fewer than the cores of the host."""
+    if hasattr(os, "sched_getaffinity"):
+        num_cpus = len(os.sched_getaffinity(0))
+    else:
+        num_cpus = os.cpu_count()
+    os.environ["OMP_NUM_THREADS"] = str(max(1, num_cpus // max(1, ngpus_per_node)))
+
+
+def gpu_count_without_cuda_init():
+    """ Number of visible GPUs, counted through NVML or CUDA_VISIBLE_DEVICES
+        without initializing CUDA in this process, which couldn't fork the
+        workers afterwards. None if it can't be counted this way."""
+    if hasattr(torch.cuda, "_device_count_nvml"):
+        count = torch.cuda._device_count_nvml()
+        if count >= 0:
+            return count
+    visible_devices = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if visible_devices is not None:
+        return len([d for d in visible_devices.split(",") if d.strip()])
+    return None
+
+
+def preprocessed_data_path(data_dir, split, *settings):
+    """ Path, without extension, of the cached preprocessed data, keyed by the
+        preprocessing settings."""
+    key = hashlib.md5("-".join(map(str, settings)).encode()).hexdigest()[:10]
+    return os.path.join(data_dir, "ext_sum_{}_{}".format(split, key))
+
+
 # How often the statistics reports show up in training, unit is step.
 REPORT_EVERY = 100
 SAVE_EVERY = 1000
@@ -159,29 +295,69 @@ def main():
     os.makedirs(args.output_dir, exist_ok=True)
     os.makedirs(args.cache_dir, exist_ok=True)
 
-    ngpus_per_node = torch.cuda.device_count()
-    processor = ExtSumProcessor(model_name=args.model_name)
-    summarizer = ExtractiveSummarizer(
-        processor, args.model_name, args.encoder, args.max_pos_length, args.cache_dir
-    )
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", "29501")
+    if args.nccl_socket_ifname:
+        os.environ["NCCL_SOCKET_IFNAME"] = args.nccl_socket_ifname
+    if args.nccl_ib_hca:
+        os.environ["NCCL_IB_HCA"] = args.nccl_ib_hca
 
-    mp.spawn(
-        main_worker, nprocs=ngpus_per_node, args=(ngpus_per_node, summarizer, args)
-    )
+    # The script can be launched with
+    #   torchrun --nnodes=NODE_COUNT --nproc_per_node=NGPUS <script> [args]
+    # or with python, in which case one process per GPU is started and the
+    # nodes rendezvous through --dist_url.
+    if "LOCAL_RANK" in os.environ:
+        # launched by torchrun, which has already started one process per GPU
+        # and set the ranks in the environment. torch.distributed.launch
+        # --use_env doesn't set LOCAL_WORLD_SIZE.
+        ngpus_per_node = int(
+            os.environ.get("LOCAL_WORLD_SIZE", torch.cuda.device_count())
+        )
+        set_omp_num_threads(ngpus_per_node)
+        main_worker(
+            int(os.environ["LOCAL_RANK"]), ngpus_per_node, args, use_env=True
+        )
+    else:
+        ngpus_per_node = gpu_count_without_cuda_init()
+        if sys.platform.startswith("linux") and ngpus_per_node is not None:
+            # forked processes share the tokenizer and the model weights with
+            # this process (copy-on-write) instead of unpickling their own copy.
+            # CUDA must not be initialized before the fork.
+            summarizer = build_summarizer(args)
+            start_method = "fork"
+        else:
+            ngpus_per_node = torch.cuda.device_count()
+            summarizer = None
+            start_method = "spawn"
+        set_omp_num_threads(ngpus_per_node)
+        mp.start_processes(
+            main_worker,
+            args=(ngpus_per_node, args, summarizer, False),
+            nprocs=ngpus_per_node,
+            start_method=start_method,
+        )
 
 
-def main_worker(local_rank, ngpus_per_node, summarizer, args):
-    rank = args.rank * ngpus_per_node + local_rank
-    world_size = args.node_count * ngpus_per_node
+def main_worker(local_rank, ngpus_per_node, args, summarizer=None, use_env=False):
+    # the ranks are read from the environment only if the launcher has set them
+    # for this process, a node-level RANK must not be taken by all its workers
+    if use_env:
+        rank = int(os.environ["RANK"])
+        world_size = int(os.environ["WORLD_SIZE"])
+        dist_url = "env://"
+    else:
+        rank = args.rank * ngpus_per_node + local_rank
+        world_size = args.node_count * ngpus_per_node
+        dist_url = args.dist_url
 
-    print("init_method: {}".format(args.dist_url))
+    print("init_method: {}".format(dist_url))
     print("ngpus_per_node: {}".format(ngpus_per_node))
     print("rank: {}".format(rank))
     print("local_rank: {}".format(local_rank))
     print("world_size: {}".format(world_size))
 
     torch.distributed.init_process_group(
-        backend="nccl", init_method=args.dist_url, world_size=world_size, rank=rank,
+        backend="nccl", init_method=dist_url, world_size=world_size, rank=rank,
     )
     # total number of steps for training
     MAX_STEPS = 1e1
@@ -196,28 +372,97 @@ def main_worker(local_rank, ngpus_per_node, summarizer, args):
     print("max steps is {}".format(MAX_STEPS))
     print("warmup steps is {}".format(WARMUP_STEPS))
 
-    if local_rank not in [-1, 0]:
-        torch.distributed.barrier()
-
     # download_path = CNNDMBertSumProcessedData.download(local_path=args.data_dir)
     # ext_sum_train, ext_sum_train = ExtSumProcessedData().splits(
     #    root=download_path, train_iterable=True
     # )
-    if args.train_file is None or args.test_file is None:
-        train_dataset, test_dataset = CNNDMSummarizationDataset(
-            top_n=TOP_N, local_cache_path=args.data_dir
+    # the training data is encoded into memory-mapped token ids shared by the
+    # processes of the node
+    preprocess = args.train_file is None or args.test_file is None
+    if preprocess:
+        train_path = preprocessed_data_path(
+            args.data_dir,
+            "train",
+            TOP_N,
+            "greedy",
+            args.model_name,
+            args.max_pos_length,
+        )
+        test_path = (
+            preprocessed_data_path(args.data_dir, "test", TOP_N, "greedy") + ".pt"
         )
-        ext_sum_train = summarizer.processor.preprocess(train_dataset, oracle_mode="greedy")
-        ext_sum_test = summarizer.processor.preprocess(test_dataset, oracle_mode="greedy")
     else:
-        ext_sum_train = torch.load(os.path.join(args.data_dir, args.train_file))
-        ext_sum_test = torch.load(os.path.join(args.data_dir, args.test_file))
+        # already preprocessed data, which is only encoded
+        train_file = os.path.join(args.data_dir, args.train_file)
+        train_path = preprocessed_data_path(
+            args.data_dir,
+            "train",
+            os.path.abspath(train_file),
+            os.path.getmtime(train_file),
+            args.model_name,
+            args.max_pos_length,
+        )
+        test_path = os.path.join(args.data_dir, args.test_file)
 
+    # only the first process of the node downloads the tokenizer and the model
+    # and prepares the data; the others wait at a single barrier and then load
+    # both from the local caches.
     if local_rank in [-1, 0]:
-        torch.distributed.barrier()
+        if summarizer is None:
+            summarizer = build_summarizer(args)
+        if preprocess and not (
+            ExtSumEncodedDataset.exists(train_path) and os.path.exists(test_path)
+        ):
+            train_dataset, test_dataset = CNNDMSummarizationDataset(
+                top_n=TOP_N, local_cache_path=args.data_dir
+            )
+            ExtSumEncodedDataset.save(
+                (
+                    summarizer.processor.encode_single(d, args.max_pos_length)
+                    for d in summarizer.processor.preprocess(
+                        train_dataset, oracle_mode="greedy"
+                    )
+                ),
+                train_path,
+            )
+            # saved under a temporary name and moved into place, so that it's
+            # never read half-written from storage shared by several nodes
+            tmp_test_path = "{}.tmp-{}".format(test_path, uuid.uuid4().hex)
+            torch.save(
+                summarizer.processor.preprocess(test_dataset, oracle_mode="greedy"),
+                tmp_test_path,
+            )
+            os.replace(tmp_test_path, test_path)
+            del train_dataset, test_dataset
+        elif not preprocess and not ExtSumEncodedDataset.exists(train_path):
+            ExtSumEncodedDataset.save(
+                (
+                    summarizer.processor.encode_single(d, args.max_pos_length)
+                    for d in torch.load(train_file)
+                ),
+                train_path,
+            )
+    torch.distributed.barrier()
+
+    # bind the process, and the data loader workers it starts, to its own cores.
+    # It's done after the data preparation, whose preprocessing pool uses all
+    # the cores of the node.
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpu_set_for_local_rank(local_rank, ngpus_per_node))
+    torch.set_num_threads(int(os.environ["OMP_NUM_THREADS"]))
+
+    # unless it was inherited through fork, the summarizer is built in each process
+    if summarizer is None:
+        summarizer = build_summarizer(args)
+    ext_sum_train = ExtSumEncodedDataset(train_path)
+    # the test data is only loaded for prediction, after training
 
     start = time.time()
 
+    batch_size = args.batch_size
+    if batch_size is None:
+        batch_size = 32 if args.grad_checkpoint == "true" else 5
+
     if rank not in [-1, 0]:
         save_every = -1
     else:
@@ -227,7 +472,7 @@ def main_worker(local_rank, ngpus_per_node, summarizer, args):
     summarizer.fit(
         ext_sum_train,
         num_gpus=world_size,
-        batch_size=args.batch_size,
+        batch_size=batch_size,
         gradient_accumulation_steps=1,
         max_steps=MAX_STEPS / world_size,
         learning_rate=args.learning_rate,
@@ -239,21 +484,33 @@ def main_worker(local_rank, ngpus_per_node, summarizer, args):
         save_every=save_every,
         world_size=world_size,
         rank=rank,
+        pin_memory=True,
+        num_workers=args.num_workers,
+        prefetch_factor=args.prefetch_factor,
+        persistent_workers=args.persistent_workers == "true",
+        precision=args.precision,
+        tokens_per_batch=args.tokens_per_batch,
+        grad_compression=args.grad_compression,
+        compile_model=args.compile == "true",
+        gradient_checkpointing=args.grad_checkpoint == "true",
+        cuda_graphs=args.cuda_graphs == "true",
         # use_preprocessed_data=True
     )
     end = time.time()
     print("rank {0}, duration {1:.6f}s".format(rank, end - start))
     # """
+    del ext_sum_train
+    gc.collect()
+
     torch.distributed.barrier()
-    if local_rank in [-1, 0] and args.rank == 0:
+    if rank == 0:
         summarizer.save_model(os.path.join(args.output_dir, args.model_filename))
+        ext_sum_test = torch.load(test_path)
         prediction = summarizer.predict(ext_sum_test[0:TOP_N], batch_size=128)
 
         def _write_list_to_file(list_items, filename):
-            with open(filename, "w") as filehandle:
-                # for cnt, line in enumerate(filehandle):
-                for item in list_items:
-                    filehandle.write("%s\n" % item)
+            with open(filename, "w", buffering=1 << 20) as filehandle:
+                filehandle.writelines("{}\n".format(item) for item in list_items)
 
         print("writing generated summaries")
         _write_list_to_file(
@@ -0,0 +1,56 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from utils_nlp.models.transformers.bertsum.neural import MultiHeadedAttention
+
+
+def _attention_outputs(monkeypatch, key, value, query, mask):
+    torch.manual_seed(0)
+    attention = MultiHeadedAttention(head_count=4, model_dim=16, dropout=0.1).eval()
+    with torch.no_grad():
+        fused = attention(key, value, query, mask=mask)
+        # fall back to the explicit softmax(QK^T)V implementation
+        monkeypatch.delattr(F, "scaled_dot_product_attention")
+        explicit = attention(key, value, query, mask=mask)
+    return fused, explicit
+
+
+@pytest.mark.cpu
+@pytest.mark.skipif(
+    not hasattr(F, "scaled_dot_product_attention"),
+    reason="scaled_dot_product_attention needs PyTorch 2.0 or later",
+)
+def test_attention_encoder_padding_mask(monkeypatch):
+    torch.manual_seed(1)
+    x = torch.randn(2, 5, 16)
+    # `[batch_size x 1 x src_len]`, True for padding, as in ExtTransformerEncoder
+    lengths = torch.tensor([5, 3])
+    mask = (torch.arange(5)[None, :] >= lengths[:, None]).unsqueeze(1)
+
+    fused, explicit = _attention_outputs(monkeypatch, x, x, x, mask)
+    assert fused.shape == (2, 5, 16)
+    assert torch.allclose(fused, explicit, atol=1e-5)
+
+
+@pytest.mark.cpu
+@pytest.mark.skipif(
+    not hasattr(F, "scaled_dot_product_attention"),
+    reason="scaled_dot_product_attention needs PyTorch 2.0 or later",
+)
+def test_attention_decoder_causal_padding_mask(monkeypatch):
+    torch.manual_seed(1)
+    x = torch.randn(2, 6, 16)
+    # `[batch_size x tgt_len x tgt_len]`, padding plus subsequent positions, as
+    # in TransformerDecoderLayer
+    lengths = torch.tensor([6, 4])
+    tgt_pad_mask = (torch.arange(6)[None, :] >= lengths[:, None]).unsqueeze(1)
+    subsequent_mask = torch.triu(torch.ones(1, 6, 6, dtype=torch.uint8), diagonal=1)
+    mask = torch.gt(tgt_pad_mask.to(torch.uint8) + subsequent_mask, 0)
+
+    fused, explicit = _attention_outputs(monkeypatch, x, x, x, mask)
+    assert fused.shape == (2, 6, 16)
+    assert torch.allclose(fused, explicit, atol=1e-5)
@@ -12,6 +12,7 @@ from utils_nlp.common.pytorch_utils import (
     get_device,
     move_model_to_device,
     parallelize_model,
+    register_gradient_compression,
 )
 
 
@@ -223,3 +224,11 @@ def test_parallelize_model(model):
         gpu_ids=[x + num_cuda_devices for x in list(range(num_cuda_devices))],
     )
     assert next(model_cuda_cpu.parameters()).is_cuda is False
+
+
+def test_register_gradient_compression_not_distributed(model):
+    # models which are not DistributedDataParallel are returned unchanged
+    assert register_gradient_compression(model, "powersgd") is model
+    assert register_gradient_compression(model, "none") is model
+    with pytest.raises(ValueError):
+        register_gradient_compression(model, "int8")
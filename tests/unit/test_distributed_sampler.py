@@ -2,7 +2,10 @@
 # Licensed under the MIT License.
 
 import pytest
-from utils_nlp.models.transformers.extractive_summarization import IterableDistributedSampler
+from utils_nlp.models.transformers.extractive_summarization import (
+    IterableDistributedSampler,
+    LengthBucketBatchSampler,
+)
 
 @pytest.mark.cpu
 def test_sampler():
@@ -31,3 +34,33 @@ def test_sampler():
     assert ''.join(samples) == 'h'
 
 
+@pytest.mark.cpu
+def test_length_bucket_batch_sampler():
+    lengths = [10, 500, 20, 480, 30, 15, 510, 25]
+    sampler = LengthBucketBatchSampler(lengths, 1000, shuffle=False)
+    batches = list(sampler)
+    assert len(batches) == len(sampler)
+    assert sorted(i for b in batches for i in b) == list(range(len(lengths)))
+    for b in batches:
+        assert len(b) == 1 or len(b) * max(lengths[i] for i in b) <= 1000
+    # the short examples are batched together
+    assert [0, 5, 2, 7, 4] in batches
+
+    # the length is the one of the epoch being iterated
+    sampler = LengthBucketBatchSampler(lengths, 100, bucket_size=3, seed=2)
+    assert len(sampler) == len(list(sampler))
+    for _ in range(3):
+        iterator = iter(sampler)
+        num_batches = len(sampler)
+        assert len(list(iterator)) == num_batches
+        assert len(sampler) == num_batches
+
+    samplers = [
+        LengthBucketBatchSampler(lengths, 1000, num_replicas=2, rank=r, seed=1)
+        for r in range(2)
+    ]
+    rank_batches = [list(s) for s in samplers]
+    assert len(rank_batches[0]) == len(rank_batches[1])
+    assert not set(i for b in rank_batches[0] for i in b) & set(
+        i for b in rank_batches[1] for i in b
+    )
@@ -1,10 +1,14 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT License.
 
+import os
+
 import nltk
 import pytest
 from nltk import tokenize
 
+from utils_nlp.models.transformers.bertsum.data_loader import Batch
+from utils_nlp.models.transformers.bertsum.dataset import ExtSumEncodedDataset
 from utils_nlp.models.transformers.datasets import SummarizationDataset
 from utils_nlp.models.transformers.extractive_summarization import (
     ExtractiveSummarizer,
@@ -66,6 +70,33 @@ def data(tmp_module):
     return processor, ext_sum_train, ext_sum_test
 
 
+@pytest.mark.cpu
+def test_encode_single(data):
+    processor = data[0]
+    example = {
+        "src": [["hello", "world"], ["good", "morning"]],
+        "tgt": [["hello"]],
+        "tgt_txt": "hello",
+        "oracle_ids": [0],
+    }
+    ids = processor.tokenizer.convert_tokens_to_ids
+    src, labels, segs, clss, _, _ = processor.encode_single(example, 512)
+    # no padding to the block size
+    assert src == ids(
+        ["[CLS]", "hello", "world", "[SEP]", "[CLS]", "good", "morning", "[SEP]"]
+    )
+    assert labels == [1, 0]
+    assert segs == [0, 0, 0, 0, 1, 1, 1, 1]
+    assert clss == [0, 4]
+
+    # truncated to the block size, still ending with [SEP]
+    src, labels, segs, clss, _, _ = processor.encode_single(example, 6)
+    assert src == ids(["[CLS]", "hello", "world", "[SEP]", "[CLS]", "[SEP]"])
+    assert labels == [1, 0]
+    assert segs == [0, 0, 0, 0, 1, 1]
+    assert clss == [0, 4]
+
+
 @pytest.mark.gpu
 def test_bert_training(data, tmp_module):
 
@@ -97,3 +128,41 @@ def test_bert_training(data, tmp_module):
 
     prediction = summarizer.predict(test_dataset, num_gpus=None, batch_size=128)
     assert len(prediction) == 1
+
+
+@pytest.mark.cpu
+def test_encoded_dataset(tmp):
+    path = os.path.join(tmp, "encoded")
+    encoded = [
+        ([101, 2023, 102, 101, 2003, 102], [1, 0], [0, 0, 0, 1, 1, 1], [0, 3], [], ""),
+        None,
+        ([101, 7592, 102], [0], [0, 0, 0], [0], [], ""),
+    ]
+    assert not ExtSumEncodedDataset.exists(path)
+    ExtSumEncodedDataset.save(iter(encoded), path)
+    assert ExtSumEncodedDataset.exists(path)
+
+    dataset = ExtSumEncodedDataset(path)
+    assert len(dataset) == 2
+    assert dataset.lengths() == [6, 3]
+    assert dataset[0] == tuple(encoded[0][:4]) + (None, None)
+    assert dataset[1] == tuple(encoded[2][:4]) + (None, None)
+
+
+@pytest.mark.cpu
+def test_batch_fixed_width():
+    data = [
+        ([101, 2023, 102, 101, 2003, 102], [1, 0], [0, 0, 0, 1, 1, 1], [0, 3], [], ""),
+        ([101, 7592, 102], [0], [0, 0, 0], [0], [], ""),
+    ]
+    batch = Batch(data, is_labeled=True)
+    assert batch.src.shape == (2, 6)
+    assert batch.clss.shape == (2, 2)
+
+    batch = Batch(data, is_labeled=True, src_width=8, cls_width=4)
+    assert batch.src.shape == (2, 8)
+    assert batch.segs.shape == (2, 8)
+    assert batch.mask.sum().item() == 9
+    assert batch.clss.shape == (2, 4)
+    assert batch.labels.shape == (2, 4)
+    assert batch.mask_cls.sum().item() == 3
@@ -0,0 +1,57 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+from utils_nlp.dataset.sentence_selection import (
+    _get_word_ngrams,
+    cal_rouge,
+    greedy_selection,
+)
+
+
+def _reference_greedy_selection(sents, abstract, summary_size):
+    evaluated_1grams = [_get_word_ngrams(1, [sent]) for sent in sents]
+    reference_1grams = _get_word_ngrams(1, [abstract])
+    evaluated_2grams = [_get_word_ngrams(2, [sent]) for sent in sents]
+    reference_2grams = _get_word_ngrams(2, [abstract])
+    max_rouge = 0.0
+    selected = []
+    for _ in range(summary_size):
+        cur_max_rouge = max_rouge
+        cur_id = -1
+        for i in range(len(sents)):
+            if i in selected:
+                continue
+            c = selected + [i]
+            candidates_1 = set.union(*[evaluated_1grams[idx] for idx in c])
+            candidates_2 = set.union(*[evaluated_2grams[idx] for idx in c])
+            rouge_score = (
+                cal_rouge(candidates_1, reference_1grams)["f"]
+                + cal_rouge(candidates_2, reference_2grams)["f"]
+            )
+            if rouge_score > cur_max_rouge:
+                cur_max_rouge = rouge_score
+                cur_id = i
+        if cur_id == -1:
+            return selected
+        selected.append(cur_id)
+        max_rouge = cur_max_rouge
+    return sorted(selected)
+
+
+def test_greedy_selection():
+    doc = [
+        "the cat sat on the mat".split(),
+        "a dog barked at the mailman".split(),
+        "the cat sat quietly".split(),
+        "nothing relevant here".split(),
+        "the mailman ran away from the dog".split(),
+        "".split(),
+    ]
+    abstract = ["the cat sat on the mat".split(), "the dog chased the mailman".split()]
+    flat_abstract = sum(abstract, [])
+    for summary_size in range(1, len(doc) + 2):
+        assert greedy_selection(
+            doc, abstract, summary_size
+        ) == _reference_greedy_selection(doc, flat_abstract, summary_size)
+    assert greedy_selection(doc, [["unrelated"]], 3) == []
+    assert greedy_selection([], abstract, 3) == []
@@ -3,6 +3,8 @@
 
 """Common PyTorch utilities that facilitate building PyTorch models."""
 
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
 from torch.utils.data.distributed import DistributedSampler
@@ -41,7 +43,9 @@ def move_model_to_device(model, device):
     return model.to(device)
 
 
-def parallelize_model(model, device, num_gpus=None, gpu_ids=None, local_rank=-1):
+def parallelize_model(
+    model, device, num_gpus=None, gpu_ids=None, local_rank=-1, ddp_kwargs=None
+):
     """Moves a model to the specified device (cpu or gpu/s)
        and implements data parallelism when multiple gpus are specified.
     Args:
@@ -59,6 +63,9 @@ def parallelize_model(model, device, num_gpus=None, gpu_ids=None, local_rank=-1)
         local_rank (int): Local GPU ID within a node. Used in distributed environments.
             If not -1, num_gpus and gpu_ids are ignored.
             Defaults to -1.
+        ddp_kwargs (dict): Additional keyword arguments passed to
+            DistributedDataParallel, e.g. `bucket_cap_mb` or `static_graph`.
+            Only used when local_rank is not -1. Defaults to None.
     Returns:
         Module, DataParallel, DistributedDataParallel: A PyTorch Module or
             a DataParallel/DistributedDataParallel wrapper,
@@ -72,11 +79,11 @@ def parallelize_model(model, device, num_gpus=None, gpu_ids=None, local_rank=-1)
     )  # Take care of distributed/parallel training
 
     if local_rank != -1:
+        kwargs = {"find_unused_parameters": True}
+        if ddp_kwargs:
+            kwargs.update(ddp_kwargs)
         model = torch.nn.parallel.DistributedDataParallel(
-            model_module,
-            device_ids=[local_rank],
-            output_device=local_rank,
-            find_unused_parameters=True,
+            model_module, device_ids=[local_rank], output_device=local_rank, **kwargs
         )
     else:
         if device.type == "cuda":
@@ -100,6 +107,185 @@ def parallelize_model(model, device, num_gpus=None, gpu_ids=None, local_rank=-1)
     return model
 
 
+def register_gradient_compression(
+    model, method="none", matrix_approximation_rank=1, start_powerSGD_iter=1000
+):
+    """Registers a communication hook which compresses the gradients all-reduced
+       by DistributedDataParallel.
+    Args:
+        model (Module): A PyTorch model. Only DistributedDataParallel models
+            are affected.
+        method (str): Compression method, one of "none", "fp16" (gradients are
+            cast to half precision) and "powersgd" (low-rank approximation of
+            the gradients). Defaults to "none".
+        matrix_approximation_rank (int): Rank of the PowerSGD approximation.
+            Defaults to 1.
+        start_powerSGD_iter (int): Number of steps run with uncompressed
+            all-reduce before PowerSGD starts. Defaults to 1000.
+    Returns:
+        Module, DistributedDataParallel: The input model.
+    """
+    if method not in ["none", "fp16", "powersgd"]:
+        raise ValueError("Gradient compression not supported: {}".format(method))
+    if method == "none" or not isinstance(
+        model, torch.nn.parallel.DistributedDataParallel
+    ):
+        return model
+
+    try:
+        from torch.distributed.algorithms.ddp_comm_hooks import (
+            default_hooks,
+            powerSGD_hook,
+        )
+    except ImportError:
+        raise ValueError("Gradient compression needs PyTorch 1.8 or later")
+
+    if method == "fp16":
+        model.register_comm_hook(state=None, hook=default_hooks.fp16_compress_hook)
+    else:
+        state = powerSGD_hook.PowerSGDState(
+            process_group=None,
+            matrix_approximation_rank=matrix_approximation_rank,
+            start_powerSGD_iter=start_powerSGD_iter,
+        )
+        model.register_comm_hook(state=state, hook=powerSGD_hook.powerSGD_hook)
+    return model
+
+
+class PinnedBufferRing:
+    """A ring of reusable page-locked host buffers used to copy batches to a GPU.
+       Allocating page-locked memory for every batch is slow, instead the tensors
+       of a batch are copied into the buffers of the next slot of the ring and
+       sent to the GPU from there. A slot is only overwritten once the copy from
+       it to the GPU has completed.
+    Args:
+        num_buffers (int): Number of slots in the ring. Defaults to 4.
+        capacity (int): Number of elements each buffer is allocated with. A
+            buffer is reallocated if a larger tensor comes. Defaults to 0.
+    """
+
+    def __init__(self, num_buffers=4, capacity=0):
+        self.slots = [{} for _ in range(num_buffers)]
+        self.events = [None] * num_buffers
+        self.capacity = capacity
+        self.index = 0
+
+    def copy_to_device(self, batch, device):
+        """Copies the tensor attributes of a batch to the device, asynchronously
+           with respect to the host, on the current stream.
+        Args:
+            batch (object): Batch with its tensors as attributes.
+            device (torch.device): A PyTorch GPU device.
+        Returns:
+            object: The batch, with its tensors on the device.
+        """
+        slot = self.slots[self.index]
+        if self.events[self.index] is not None:
+            self.events[self.index].synchronize()
+
+        for name, value in list(vars(batch).items()):
+            if not torch.is_tensor(value):
+                continue
+            buffer = slot.get(name)
+            if (
+                buffer is None
+                or buffer.dtype != value.dtype
+                or buffer.numel() < value.numel()
+            ):
+                buffer = torch.empty(
+                    max(value.numel(), self.capacity),
+                    dtype=value.dtype,
+                    pin_memory=True,
+                )
+                slot[name] = buffer
+            staged = buffer[: value.numel()].view(value.size())
+            staged.copy_(value)
+            setattr(batch, name, staged.to(device, non_blocking=True))
+
+        self.events[self.index] = torch.cuda.Event()
+        self.events[self.index].record()
+        self.index = (self.index + 1) % len(self.slots)
+        return batch
+
+
+def prefetch_to_device(batches, device, buffer_ring=None):
+    """Iterates over batches which are loaded and copied to the GPU by a
+       background thread on a separate CUDA stream, so that loading and copying
+       the next batch overlaps with the computation on the current one.
+    Args:
+        batches (iterable): Batches, e.g. a DataLoader, yielding objects with
+            `pin_memory()` and `to(device, non_blocking)` methods and their
+            tensors as attributes, like
+            :class:`utils_nlp.models.transformers.bertsum.data_loader.Batch`.
+        device (torch.device): A PyTorch device. If it's not a GPU, the batches
+            are returned as they are.
+        buffer_ring (PinnedBufferRing): If set, the batches are staged in its
+            reusable page-locked buffers instead of being pinned one by one.
+            Defaults to None.
+    Returns:
+        generator: The batches on the device.
+    """
+    if device.type != "cuda":
+        yield from batches
+        return
+
+    stream = torch.cuda.Stream(device=device)
+    iterator = iter(batches)
+    end = object()
+
+    def load_next():
+        batch = next(iterator, end)
+        if batch is end or batch is None:
+            return batch, None
+        with torch.cuda.stream(stream):
+            if buffer_ring is None:
+                batch = batch.pin_memory().to(device, non_blocking=True)
+            else:
+                batch = buffer_ring.copy_to_device(batch, device)
+            copied = torch.cuda.Event()
+            copied.record(stream)
+        return batch, copied
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(load_next)
+        while True:
+            batch, copied = future.result()
+            if batch is end:
+                break
+            future = executor.submit(load_next)
+            if copied is not None:
+                current_stream = torch.cuda.current_stream(device)
+                current_stream.wait_event(copied)
+                # the memory was allocated on the side stream, keep it from being
+                # reused before the current stream is done with it
+                for value in vars(batch).values():
+                    if torch.is_tensor(value):
+                        value.record_stream(current_stream)
+            yield batch
+
+
+class DevicePrefetchLoader:
+    """Wraps a DataLoader so that every iteration over it goes through
+       :func:`prefetch_to_device`.
+    Args:
+        dataloader (DataLoader): A PyTorch DataLoader.
+        device (torch.device): A PyTorch device.
+        buffer_ring (PinnedBufferRing): See :func:`prefetch_to_device`.
+            Defaults to None.
+    """
+
+    def __init__(self, dataloader, device, buffer_ring=None):
+        self.dataloader = dataloader
+        self.device = device
+        self.buffer_ring = buffer_ring
+
+    def __iter__(self):
+        return prefetch_to_device(self.dataloader, self.device, self.buffer_ring)
+
+    def __len__(self):
+        return len(self.dataloader)
+
+
 def dataloader_from_dataset(
     ds, batch_size=32, num_gpus=None, shuffle=False, distributed=False
 ):
@@ -7,6 +7,9 @@
 import itertools
 import re
 
+import numpy as np
+from scipy import sparse
+
 
 def _get_ngrams(n, text):
     """Calcualtes n-grams.
@@ -92,6 +95,60 @@ def combination_selection(doc_sent_list, abstract_sent_list, summary_size):
     return sorted(list(max_idx))
 
 
+def _ngram_incidence(sents_ngrams, reference_ngrams):
+    """Builds a binary (sentence x n-gram) CSR matrix and a reference indicator.
+    Args:
+      sents_ngrams: A list of n-gram sets, one per sentence
+      reference_ngrams: The set of n-grams of the reference summary
+    Returns:
+      A tuple of the incidence matrix and a boolean vector marking which
+      columns are reference n-grams
+    """
+    vocab = {}
+    indices = []
+    indptr = [0]
+    for ngrams in sents_ngrams:
+        indices.extend(vocab.setdefault(g, len(vocab)) for g in ngrams)
+        indptr.append(len(indices))
+    data = np.ones(len(indices), dtype=np.int32)
+    incidence = sparse.csr_matrix(
+        (
+            data,
+            np.asarray(indices, dtype=np.int64),
+            np.asarray(indptr, dtype=np.int64),
+        ),
+        shape=(len(sents_ngrams), len(vocab)),
+    )
+    in_reference = np.fromiter(
+        (g in reference_ngrams for g in vocab), dtype=bool, count=len(vocab)
+    )
+    return incidence, in_reference
+
+
+def _batched_rouge_f(incidence, in_reference, reference_count, covered):
+    """Computes cal_rouge's F score of (covered n-grams + each sentence) for
+    all sentences.
+
+    Set union and intersection sizes are obtained with two sparse mat-vec
+    products against the n-grams not yet covered by the current selection.
+    """
+    uncovered = (~covered).astype(np.int32)
+    evaluated_count = covered.sum() + incidence.dot(uncovered)
+    overlapping_count = (covered & in_reference).sum() + incidence.dot(
+        uncovered * in_reference
+    )
+
+    precision = np.zeros(len(evaluated_count))
+    np.divide(
+        overlapping_count, evaluated_count, out=precision, where=evaluated_count > 0
+    )
+    if reference_count == 0:
+        recall = np.zeros(len(evaluated_count))
+    else:
+        recall = overlapping_count / reference_count
+    return 2.0 * ((precision * recall) / (precision + recall + 1e-8))
+
+
 def greedy_selection(doc_sent_list, abstract_sent_list, summary_size):
     def _rouge_clean(s):
         return re.sub(r'[^a-zA-Z0-9 ]', '', s)
@@ -106,26 +163,31 @@ def greedy_selection(doc_sent_list, abstract_sent_list, summary_size):
     reference_2grams = _get_word_ngrams(2, [abstract])
 
     selected = []
+    if len(sents) == 0:
+        return selected
+
+    # Score every candidate sentence at once instead of re-building the n-gram
+    # unions in Python for each (selected + [i]) combination.
+    incidence_1, in_reference_1 = _ngram_incidence(evaluated_1grams, reference_1grams)
+    incidence_2, in_reference_2 = _ngram_incidence(evaluated_2grams, reference_2grams)
+    covered_1 = np.zeros(incidence_1.shape[1], dtype=bool)
+    covered_2 = np.zeros(incidence_2.shape[1], dtype=bool)
+
     for s in range(summary_size):
-        cur_max_rouge = max_rouge
-        cur_id = -1
-        for i in range(len(sents)):
-            if (i in selected):
-                continue
-            c = selected + [i]
-            candidates_1 = [evaluated_1grams[idx] for idx in c]
-            candidates_1 = set.union(*map(set, candidates_1))
-            candidates_2 = [evaluated_2grams[idx] for idx in c]
-            candidates_2 = set.union(*map(set, candidates_2))
-            rouge_1 = cal_rouge(candidates_1, reference_1grams)['f']
-            rouge_2 = cal_rouge(candidates_2, reference_2grams)['f']
-            rouge_score = rouge_1 + rouge_2
-            if rouge_score > cur_max_rouge:
-                cur_max_rouge = rouge_score
-                cur_id = i
-        if (cur_id == -1):
+        rouge_scores = _batched_rouge_f(
+            incidence_1, in_reference_1, len(reference_1grams), covered_1
+        ) + _batched_rouge_f(
+            incidence_2, in_reference_2, len(reference_2grams), covered_2
+        )
+        rouge_scores[selected] = -np.inf
+        # argmax returns the first maximum, matching the strict ">" of a
+        # sequential scan
+        cur_id = int(np.argmax(rouge_scores))
+        if not rouge_scores[cur_id] > max_rouge:
             return selected
         selected.append(cur_id)
-        max_rouge = cur_max_rouge
+        max_rouge = rouge_scores[cur_id]
+        covered_1[incidence_1[cur_id].indices] = True
+        covered_2[incidence_2[cur_id].indices] = True
 
     return sorted(selected)
@@ -32,6 +32,102 @@ class IterableDistributedSampler(object):
             return iterable
 
 
+class LengthBucketBatchSampler(object):
+    """ Batch sampler which groups examples of similar lengths so that little
+    padding is needed, and limits each batch by its number of tokens instead
+    of its number of examples.
+
+    The shuffled examples are split into buckets of `bucket_size` examples and
+    each bucket is sorted by length before it's cut into batches. The batches
+    are reshuffled every time the sampler is iterated.
+
+    Args:
+        lengths (list): Number of tokens of each example in the dataset.
+        tokens_per_batch (int): Maximum number of tokens in a batch, padding
+            included, i.e. the batch size times the longest example in it.
+            An example longer than this value is put in a batch by itself.
+        shuffle (bool, optional): Whether the data is shuffled. Defaults to True.
+        bucket_size (int, optional): Number of examples sorted together.
+            Defaults to 1000.
+        num_replicas (int, optional): Number of processes in distributed
+            training. Each of them gets the same number of batches and the
+            batches left over are dropped. Defaults to 1.
+        rank (int, optional): Rank of the current process. Defaults to 0.
+        seed (int, optional): Random seed, which must be the same for all the
+            processes. Defaults to 0.
+
+    """
+
+    def __init__(
+        self,
+        lengths,
+        tokens_per_batch,
+        shuffle=True,
+        bucket_size=1000,
+        num_replicas=1,
+        rank=0,
+        seed=0,
+    ):
+        self.lengths = lengths
+        self.tokens_per_batch = tokens_per_batch
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        # batches of the epoch being iterated, or of the next one
+        self._batches = None
+        self._batches_epoch = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self._batches = None
+
+    def _epoch_batches(self, epoch):
+        if self._batches is None or self._batches_epoch != epoch:
+            self._batches = self._create_batches(epoch)
+            self._batches_epoch = epoch
+        return self._batches
+
+    def _create_batches(self, epoch):
+        rng = random.Random(self.seed + epoch)
+        indices = list(range(len(self.lengths)))
+        if self.shuffle:
+            rng.shuffle(indices)
+
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = sorted(
+                indices[start : start + self.bucket_size], key=lambda i: self.lengths[i]
+            )
+            batch, max_length = [], 0
+            for i in bucket:
+                new_max_length = max(max_length, self.lengths[i])
+                if batch and new_max_length * (len(batch) + 1) > self.tokens_per_batch:
+                    batches.append(batch)
+                    batch, new_max_length = [], self.lengths[i]
+                batch.append(i)
+                max_length = new_max_length
+            if batch:
+                batches.append(batch)
+
+        if self.shuffle:
+            rng.shuffle(batches)
+        num_batches = len(batches) // self.num_replicas * self.num_replicas
+        return batches[self.rank : num_batches : self.num_replicas]
+
+    def __iter__(self):
+        batches = self._epoch_batches(self.epoch)
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        if self._batches is not None:
+            return len(self._batches)
+        return len(self._epoch_batches(self.epoch))
+
+
 class ChunkDataLoader(object):
     """ Data Loader for Chunked Dataset.
 
@@ -91,8 +187,12 @@ class Batch(object):
         rtn_data = [d + [pad_id] * (width - len(d)) for d in data]
         return rtn_data
 
-    def __init__(self, data=None, is_labeled=False):
-        """Create a Batch from a list of examples."""
+    def __init__(self, data=None, is_labeled=False, src_width=-1, cls_width=-1):
+        """Create a Batch from a list of examples.
+
+        The tokens are padded to `src_width` and the sentences to `cls_width`,
+        or to the longest example in the batch if they are -1.
+        """
         if data is None or len(data) == 0:
             raise ValueError("data is empty")
         self.batch_size = len(data)
@@ -100,17 +200,17 @@ class Batch(object):
         pre_segs = [x[2] for x in data]
         pre_clss = [x[3] for x in data]
 
-        src = torch.tensor(self._pad(pre_src, 0))
+        src = torch.tensor(self._pad(pre_src, 0, src_width))
 
         pre_labels = None
         labels = None
         if is_labeled:
             pre_labels = [x[1] for x in data]
-            labels = torch.tensor(self._pad(pre_labels, 0))
-        segs = torch.tensor(self._pad(pre_segs, 0))
+            labels = torch.tensor(self._pad(pre_labels, 0, cls_width))
+        segs = torch.tensor(self._pad(pre_segs, 0, src_width))
         mask = ~(src == 0)
 
-        clss = torch.tensor(self._pad(pre_clss, -1))
+        clss = torch.tensor(self._pad(pre_clss, -1, cls_width))
         mask_cls = ~(clss == -1)
         clss[clss == -1] = 0
 
@@ -128,12 +228,12 @@ class Batch(object):
             tgt_str = [x[5] for x in data]
             setattr(self, "tgt_str", tgt_str)
 
-    def to(self, device):
-        src = self.src.to(device)
-        segs = self.segs.to(device)
-        clss = self.clss.to(device)
-        mask = self.mask.to(device)
-        mask_cls = self.mask_cls.to(device)
+    def to(self, device, non_blocking=False):
+        src = self.src.to(device, non_blocking=non_blocking)
+        segs = self.segs.to(device, non_blocking=non_blocking)
+        clss = self.clss.to(device, non_blocking=non_blocking)
+        mask = self.mask.to(device, non_blocking=non_blocking)
+        mask_cls = self.mask_cls.to(device, non_blocking=non_blocking)
 
         setattr(self, "clss", clss)
         setattr(self, "mask_cls", mask_cls)
@@ -141,9 +241,18 @@ class Batch(object):
         setattr(self, "segs", segs)
         setattr(self, "mask", mask)
         if hasattr(self, "labels"):
-            labels = self.labels.to(device)
-            setattr(self, "labels", labels.to(device))
+            labels = self.labels.to(device, non_blocking=non_blocking)
+            setattr(self, "labels", labels)
+
+        return self
 
+    def pin_memory(self):
+        """ Copy the tensor fields into page-locked memory. It's called by
+            `torch.utils.data.DataLoader` when `pin_memory=True`, which doesn't
+            know how to pin a custom batch type otherwise."""
+        for name in ["src", "segs", "clss", "mask", "mask_cls", "labels"]:
+            if hasattr(self, name):
+                setattr(self, name, getattr(self, name).pin_memory())
         return self
 
     def __len__(self):
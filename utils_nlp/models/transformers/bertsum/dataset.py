@@ -1,4 +1,8 @@
 import itertools
+import os
+import uuid
+
+import numpy as np
 import torch
 from torch.utils.data import (
     Dataset,
@@ -68,3 +72,109 @@ class ExtSumProcessedDataset(Dataset):
 
     def __getitem__(self, idx):
         return self.data[idx]
+
+
+class ExtSumEncodedDataset(Dataset):
+    """Dataset of encoded extractive summarization training examples, whose token
+    ids are stored in flat int32 files that are memory-mapped. The processes
+    reading the same dataset share its pages through the OS page cache instead
+    of each deserializing its own copy.
+    """
+
+    FIELDS = ["src", "labels", "segs", "clss"]
+
+    def __init__(self, path):
+        """ Initiation function for dataset of encoded extractive summarization
+            examples.
+
+        Args:
+            path (str): Path prefix the dataset is saved to with
+                :meth:`ExtSumEncodedDataset.save`.
+        """
+
+        self.path = path
+        self.offsets = np.load(path + ".offsets.npy")
+        self.arrays = {}
+        for field in self.FIELDS:
+            file_name = "{}.{}.bin".format(path, field)
+            if os.path.getsize(file_name) == 0:
+                self.arrays[field] = np.zeros(0, dtype=np.int32)
+            else:
+                self.arrays[field] = np.memmap(file_name, dtype=np.int32, mode="r")
+
+    @staticmethod
+    def exists(path):
+        """ Whether a dataset has been completely saved to the path prefix."""
+        return os.path.exists(path + ".offsets.npy")
+
+    @staticmethod
+    def save(encoded_data, path):
+        """ Save encoded examples to files starting with the path prefix.
+
+        Args:
+            encoded_data (iterable): Encoded examples, i.e. tuples starting with
+                the input ids, labels, segment ids and sentence class ids, as
+                returned by `ExtSumProcessor.encode_single`. None values are
+                skipped.
+            path (str): Path prefix of the files.
+        """
+
+        # the files are written under temporary names and moved into place, so
+        # that processes which already memory-map a previous version of the
+        # dataset, e.g. on other nodes sharing the storage, keep reading it
+        tmp_suffix = ".tmp-{}".format(uuid.uuid4().hex)
+        file_names = {
+            field: "{}.{}.bin".format(path, field)
+            for field in ExtSumEncodedDataset.FIELDS
+        }
+        offsets_file_name = path + ".offsets.npy"
+        tmp_file_names = [
+            name + tmp_suffix
+            for name in list(file_names.values()) + [offsets_file_name]
+        ]
+        try:
+            files = {
+                field: open(name + tmp_suffix, "wb")
+                for field, name in file_names.items()
+            }
+            offsets = [[0] * len(files)]
+            try:
+                for example in encoded_data:
+                    if example is None:
+                        continue
+                    offset = []
+                    for i, field in enumerate(ExtSumEncodedDataset.FIELDS):
+                        values = np.asarray(example[i], dtype=np.int32)
+                        files[field].write(values.tobytes())
+                        offset.append(offsets[-1][i] + len(values))
+                    offsets.append(offset)
+            finally:
+                for f in files.values():
+                    f.close()
+            with open(offsets_file_name + tmp_suffix, "wb") as f:
+                np.save(f, np.asarray(offsets, dtype=np.int64))
+        except BaseException:
+            for name in tmp_file_names:
+                if os.path.exists(name):
+                    os.remove(name)
+            raise
+
+        for name in file_names.values():
+            os.replace(name + tmp_suffix, name)
+        # moved last, it marks the dataset as complete
+        os.replace(offsets_file_name + tmp_suffix, offsets_file_name)
+
+    def lengths(self):
+        """ Number of input tokens of each example."""
+        return np.diff(self.offsets[:, 0]).tolist()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        example = [
+            self.arrays[field][self.offsets[idx, i] : self.offsets[idx + 1, i]].tolist()
+            for i, field in enumerate(self.FIELDS)
+        ]
+        # no source and target text for training
+        return tuple(example) + (None, None)
@@ -184,6 +184,15 @@ class BertSumExt(nn.Module):
     def load_cp(self, pt):
         self.load_state_dict(pt['model'], strict=True)
 
+    def gradient_checkpointing_enable(self):
+        """ Recompute the activations of the pretrained transformer layers in the
+            backward pass instead of keeping them in memory."""
+        if not hasattr(self.transformer.model, "gradient_checkpointing_enable"):
+            raise ValueError(
+                "Gradient checkpointing needs transformers 4.11 or later"
+            )
+        self.transformer.model.gradient_checkpointing_enable()
+
     def forward(self, x, segs, clss, mask, mask_cls, labels=None, sentence_range=None):
 
         top_vec = self.transformer(x, segs, mask)
@@ -191,7 +200,14 @@ class BertSumExt(nn.Module):
         sents_vec = sents_vec * mask_cls[:, :, None].float()
         sent_scores = self.encoder(sents_vec, mask_cls).squeeze(-1)
         if labels is not None:
-            loss = self.loss(sent_scores, labels.float())
+            if hasattr(torch, "autocast") and torch.is_autocast_enabled():
+                # BCELoss is not autocast-safe, the loss is computed in fp32
+                with torch.autocast(
+                    device_type=sent_scores.device.type, enabled=False
+                ):
+                    loss = self.loss(sent_scores.float(), labels.float())
+            else:
+                loss = self.loss(sent_scores.float(), labels.float())
             loss = (loss*mask_cls.float()).sum()
             sent_scores = sent_scores + mask_cls.float()
             return loss, sent_scores, mask_cls
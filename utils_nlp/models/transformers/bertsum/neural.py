@@ -427,6 +427,25 @@ class MultiHeadedAttention(nn.Module):
         key_len = key.size(2)
         query_len = query.size(2)
 
+        # 2) and 3) Fused attention kernel, e.g. FlashAttention, if available.
+        if predefined_graph_1 is None and hasattr(F, "scaled_dot_product_attention"):
+            attn_mask = None
+            if mask is not None:
+                # the boolean mask of scaled_dot_product_attention is True for
+                # the keys which are attended to
+                attn_mask = ~mask.bool().unsqueeze(1)
+            context = F.scaled_dot_product_attention(
+                query,
+                key,
+                value,
+                attn_mask=attn_mask,
+                dropout_p=self.dropout.p if self.training else 0.0,
+            )
+            if self.use_final_linear:
+                return self.final_linear(unshape(context))
+            else:
+                return context
+
         # 2) Calculate and scale scores.
         query = query / math.sqrt(dim_per_head)
         scores = torch.matmul(query, key.transpose(2, 3))
@@ -4,6 +4,8 @@
 
 
 """ Optimizers class """
+import inspect
+
 import torch
 import torch.optim as optim
 from torch.nn.utils import clip_grad_norm_
@@ -187,7 +189,11 @@ class Optimizer(object):
             self.optimizer = optim.Adadelta(self.params, lr=self.learning_rate)
         elif self.method == "adam":
             self.optimizer = optim.Adam(
-                self.params, lr=self.learning_rate, betas=self.betas, eps=1e-9
+                self.params,
+                lr=self.learning_rate,
+                betas=self.betas,
+                eps=1e-9,
+                **self._multi_tensor_kwargs()
             )
         else:
             raise RuntimeError("Invalid optim method: " + self.method)
@@ -195,6 +201,18 @@ class Optimizer(object):
         self.param_groups = self.optimizer.param_groups
         self.state = self.optimizer.state
 
+    def _multi_tensor_kwargs(self):
+        """ Keyword arguments which make Adam update all the parameters with a
+        few kernel launches instead of several per parameter: the fused kernel
+        if all the parameters are on GPU, the foreach implementation otherwise,
+        as far as the installed PyTorch supports them."""
+        adam_args = inspect.signature(optim.Adam).parameters
+        if "fused" in adam_args and self.params and all(p.is_cuda for p in self.params):
+            return {"fused": True}
+        if "foreach" in adam_args:
+            return {"foreach": True}
+        return {}
+
     def _set_rate(self, learning_rate):
         self.learning_rate = learning_rate
         if self.method != "sparseadam":
@@ -4,6 +4,7 @@
 # This script reuses some code from
 # https://github.com/huggingface/pytorch-transformers/blob/master/examples/run_glue.py
 
+import contextlib
 import datetime
 import logging
 import os
@@ -24,6 +25,8 @@ from utils_nlp.common.pytorch_utils import (
 
 MAX_SEQ_LEN = 512
 
+AUTOCAST_DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16}
+
 logger = logging.getLogger(__name__)
 
 
@@ -169,6 +172,7 @@ class Transformer:
         save_every=-1,
         clip_grad_norm=True,
         validation_function=None,
+        precision="fp32",
     ):
 
         if seed is not None:
@@ -181,6 +185,20 @@ class Transformer:
         self.model.train()
         self.model.zero_grad()
 
+        # native mixed precision; fp16 needs loss scaling, bf16 doesn't
+        if precision != "fp32" and not hasattr(torch, "autocast"):
+            raise ValueError(
+                "Precision {} needs PyTorch 1.10 or later".format(precision)
+            )
+        autocast_dtype = AUTOCAST_DTYPES.get(precision)
+        scaler = torch.cuda.amp.GradScaler() if precision == "fp16" else None
+
+        def optimizer_step(o):
+            if scaler:
+                scaler.step(o)
+            else:
+                o.step()
+
         # train
         start = time.time()
         # TODO: Is this while necessary???
@@ -191,27 +209,48 @@ class Transformer:
                 disable=local_rank not in [-1, 0] or not verbose,
             )
             for step, batch in enumerate(epoch_iterator):
-                inputs = get_inputs(batch, device, self.model_name)
-                outputs = self.model(**inputs)
-
-                if isinstance(outputs, tuple):
-                    loss = outputs[0]
+                # skip the gradient all-reduce of DistributedDataParallel on the
+                # micro-batches that don't update the parameters
+                if (step + 1) % gradient_accumulation_steps != 0 and hasattr(
+                    self.model, "no_sync"
+                ):
+                    sync_context = self.model.no_sync()
                 else:
-                    # Accomondate models based on older versions of Transformers,
-                    # e.g. UniLM
-                    loss = outputs
-
-                if num_gpus > 1:
-                    loss = loss.mean()
-
-                if gradient_accumulation_steps > 1:
-                    loss = loss / gradient_accumulation_steps
+                    # no-op context, contextlib.nullcontext needs Python 3.7
+                    sync_context = contextlib.suppress()
 
-                if fp16 and amp:
-                    with amp.scale_loss(loss, optimizer) as scaled_loss:
-                        scaled_loss.backward()
+                if autocast_dtype:
+                    autocast_context = torch.autocast(
+                        device_type=device.type, dtype=autocast_dtype
+                    )
                 else:
-                    loss.backward()
+                    autocast_context = contextlib.suppress()
+
+                with sync_context:
+                    inputs = get_inputs(batch, device, self.model_name)
+                    with autocast_context:
+                        outputs = self.model(**inputs)
+
+                    if isinstance(outputs, tuple):
+                        loss = outputs[0]
+                    else:
+                        # Accomondate models based on older versions of
+                        # Transformers, e.g. UniLM
+                        loss = outputs
+
+                    if num_gpus > 1:
+                        loss = loss.mean()
+
+                    if gradient_accumulation_steps > 1:
+                        loss = loss / gradient_accumulation_steps
+
+                    if fp16 and amp:
+                        with amp.scale_loss(loss, optimizer) as scaled_loss:
+                            scaled_loss.backward()
+                    elif scaler:
+                        scaler.scale(loss).backward()
+                    else:
+                        loss.backward()
 
                 tr_loss += loss.item()
                 accum_loss += loss.item()
@@ -221,6 +260,11 @@ class Transformer:
                     global_step += 1
 
                     if clip_grad_norm:
+                        if scaler and optimizer:
+                            for o in (
+                                optimizer if type(optimizer) == list else [optimizer]
+                            ):
+                                scaler.unscale_(o)
                         if fp16 and amp:
                             torch.nn.utils.clip_grad_norm_(
                                 amp.master_params(optimizer), max_grad_norm
@@ -254,9 +298,11 @@ class Transformer:
                     if optimizer:
                         if type(optimizer) == list:
                             for o in optimizer:
-                                o.step()
+                                optimizer_step(o)
                         else:
-                            optimizer.step()
+                            optimizer_step(optimizer)
+                        if scaler:
+                            scaler.update()
                     if scheduler:
                         if type(scheduler) == list:
                             for s in scheduler:
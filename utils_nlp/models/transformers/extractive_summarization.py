@@ -4,10 +4,12 @@
 # This script reuses some code from https://github.com/nlpyang/BertSum
 
 import functools
+import inspect
 import itertools
 import logging
 import os
 import pickle
+import random
 from multiprocessing import Pool, cpu_count
 
 import numpy as np
@@ -17,23 +19,25 @@ from torch.utils.data.distributed import DistributedSampler
 from transformers import AutoTokenizer, BertModel, DistilBertModel
 
 from utils_nlp.common.pytorch_utils import (
+    DevicePrefetchLoader,
+    PinnedBufferRing,
     compute_training_steps,
     get_device,
     move_model_to_device,
     parallelize_model,
+    prefetch_to_device,
+    register_gradient_compression,
 )
 from utils_nlp.dataset.sentence_selection import combination_selection, greedy_selection
-from utils_nlp.models.transformers.abstractive_summarization_bertsum import (
-    fit_to_block_size,
-)
-
 from utils_nlp.models.transformers.bertsum import model_builder
 from utils_nlp.models.transformers.bertsum.data_loader import (
     Batch,
     ChunkDataLoader,
     IterableDistributedSampler,
+    LengthBucketBatchSampler,
 )
 from utils_nlp.models.transformers.bertsum.dataset import (
+    ExtSumEncodedDataset,
     ExtSumProcessedDataset,
     ExtSumProcessedIterableDataset,
 )
@@ -85,6 +89,14 @@ def get_dataloader(
     )
 
 
+def _seed_worker(worker_id):
+    """ Seed the python and numpy RNGs of a data loader worker from the seed
+        torch assigns to it, so that workers don't share the same random state."""
+    worker_seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+
 def get_pred(
     example,
     sent_scores,
@@ -343,15 +355,17 @@ class ExtSumProcessor:
 
         """
         self.model_name = model_name
+        # the Rust-backed fast tokenizer
         self.tokenizer = AutoTokenizer.from_pretrained(
             model_name,
             do_lower_case=to_lower,
             cache_dir=cache_dir,
             output_loading_info=False,
+            use_fast=True,
         )
-        self.sep_vid = self.tokenizer.vocab["[SEP]"]
-        self.cls_vid = self.tokenizer.vocab["[CLS]"]
-        self.pad_vid = self.tokenizer.vocab["[PAD]"]
+        self.sep_vid = self.tokenizer.convert_tokens_to_ids("[SEP]")
+        self.cls_vid = self.tokenizer.convert_tokens_to_ids("[CLS]")
+        self.pad_vid = self.tokenizer.convert_tokens_to_ids("[PAD]")
 
         self.max_nsents = max_nsents
         self.max_src_ntokens = max_src_ntokens
@@ -387,7 +401,8 @@ class ExtSumProcessor:
                 ids, masks for the input ids, masks for  sentence class ids and source
                 text. If train_model is True, it also contains the labels and target
                 text.
-            device (torch.device): A PyTorch device.
+            device (torch.device): A PyTorch device. The copy to the device is
+                asynchronous if the batch is in pinned memory.
             model_name (bool): Model name used to format the inputs.
             train_mode (bool, optional): Training mode flag.
                 Defaults to True.
@@ -400,7 +415,7 @@ class ExtSumProcessor:
 
         if model_name.split("-")[0] in ["bert", "distilbert"]:
             if train_mode:
-                batch = batch.to(device)
+                batch = batch.to(device, non_blocking=True)
                 # labels must be the last
                 return {
                     "x": batch.src,
@@ -411,7 +426,7 @@ class ExtSumProcessor:
                     "labels": batch.labels,
                 }
             else:
-                batch = batch.to(device)
+                batch = batch.to(device, non_blocking=True)
                 return {
                     "x": batch.src,
                     "segs": batch.segs,
@@ -452,13 +467,16 @@ class ExtSumProcessor:
         )
         return parallel_preprocess(input_data_list, preprocess)
 
-    def collate(self, data, block_size, device, train_mode=True):
+    def collate(self, data, block_size, device, train_mode=True, fixed_width=False):
         """ Collcate function for pytorch data loaders.
             Args:
                 data (list): A list of samples from SummarizationDataset.
                 block_size (int): maximum input length for the model.
                 train_mode (bool): whether the collate function is used for training
                     or not. Defaults to True.
+                fixed_width (bool): whether to pad the training examples to
+                    `block_size` tokens instead of the longest one in the batch,
+                    so that all batches have the same shape. Defaults to False.
 
             Returns:
                 `Batch` object: a data minibatch as the input of a model.
@@ -470,7 +488,15 @@ class ExtSumProcessor:
         else:
             if train_mode is True and "tgt" in data[0] and "oracle_ids" in data[0]:
                 encoded_text = [self.encode_single(d, block_size) for d in data]
-                batch = Batch(list(filter(None, encoded_text)), True)
+                batch = Batch(
+                    list(filter(None, encoded_text)),
+                    True,
+                    **(
+                        _fixed_batch_widths(block_size, self.max_nsents)
+                        if fixed_width
+                        else {}
+                    ),
+                )
             else:
                 encoded_text = [
                     self.encode_single(d, block_size, train_mode) for d in data
@@ -491,7 +517,9 @@ class ExtSumProcessor:
                 block_size (int): maximum input length for the model.
 
             Returns:
-                Tuple of encoded data.
+                Tuple of encoded data. The input ids are truncated to `block_size`
+                and always end with [SEP], but they are not padded; `Batch` pads
+                them to the longest input of the batch.
 
         """
 
@@ -531,13 +559,9 @@ class ExtSumProcessor:
         text = " [SEP] [CLS] ".join(src_txt)
         src_subtokens = self.tokenizer.tokenize(text)
         # src_subtokens = src_subtokens[:510]
-        src_subtokens = (
-            ["[CLS]"]
-            + fit_to_block_size(
-                src_subtokens, block_size - 2, self.tokenizer.pad_token_id
-            )
-            + ["[SEP]"]
-        )
+        # the sequence is only truncated, Batch pads it to the longest one in
+        # the batch
+        src_subtokens = ["[CLS]"] + src_subtokens[: block_size - 2] + ["[SEP]"]
         src_subtoken_idxs = self.tokenizer.convert_tokens_to_ids(src_subtokens)
         _segs = [-1] + [i for i, t in enumerate(src_subtoken_idxs) if t == self.sep_vid]
         segs = [_segs[i] - _segs[i - 1] for i in range(1, len(_segs))]
@@ -554,6 +578,14 @@ class ExtSumProcessor:
         return src_subtoken_idxs, labels, segments_ids, cls_ids, src_txt, tgt_txt
 
 
+def _fixed_batch_widths(block_size, max_nsents):
+    """ Widths that every training example encoded with `block_size` fits in.
+        Each [CLS] token is followed by at least a [SEP] token, so there are
+        at most `block_size // 2` sentences, and at most `max_nsents` sentences
+        are kept for training."""
+    return {"src_width": block_size, "cls_width": min(block_size // 2, max_nsents)}
+
+
 class ExtractiveSummarizer(Transformer):
     """class which performs extractive summarization fine tuning and prediction """
 
@@ -643,13 +675,27 @@ class ExtractiveSummarizer(Transformer):
         world_size=1,
         rank=0,
         use_preprocessed_data=False,
+        pin_memory=False,
+        num_workers=0,
+        prefetch_factor=2,
+        persistent_workers=False,
+        bucket_cap_mb=50,
+        precision="fp32",
+        tokens_per_batch=None,
+        grad_compression="none",
+        compile_model=False,
+        gradient_checkpointing=False,
+        cuda_graphs=False,
         **kwargs,
     ):
         """
         Fine-tune pre-trained transofmer models for extractive summarization.
 
         Args:
-            train_dataset (ExtSumProcessedIterableDataset): Training dataset.
+            train_dataset (ExtSumProcessedIterableDataset, list or
+                ExtSumEncodedDataset): Training dataset. Lists of preprocessed
+                examples are encoded batch by batch during training, examples of
+                an ExtSumEncodedDataset are already encoded.
             num_gpus (int, optional): The number of GPUs to use.
                 If None, all available GPUs will be used. If set to 0 or GPUs are not
                 available, CPU device will be used. Defaults to None.
@@ -695,14 +741,68 @@ class ExtractiveSummarizer(Transformer):
                 node. See an example in :file: `examples/text_summarization/
                 extractive_summarization_cnndm_distributed_train.py`.
                 Defaults to 0.
+            pin_memory (bool, optional): Whether to copy the batches to the GPU
+                asynchronously, from a ring of reusable page-locked host buffers
+                and on a background thread, while the previous batch is being
+                processed. Defaults to False.
+            num_workers (int, optional): Number of subprocesses used to collate
+                the training batches. Defaults to 0, which means the batches are
+                collated in the training process.
+            prefetch_factor (int, optional): Number of batches loaded in advance
+                by each worker. Only used when `num_workers` > 0 and ignored
+                before PyTorch 1.7. Defaults to 2.
+            persistent_workers (bool, optional): Whether to keep the workers alive
+                between epochs. Only used when `num_workers` > 0 and ignored
+                before PyTorch 1.7. Defaults to False.
+            bucket_cap_mb (int, optional): Size in megabytes of the gradient
+                buckets that DistributedDataParallel all-reduces while the
+                backward pass is still running. Only used in distributed
+                training. Defaults to 50.
+            precision (str, optional): Precision of the forward pass. "fp16" and
+                "bf16" run it under `torch.autocast` (PyTorch 1.10 or later), with
+                a gradient scaler for "fp16". Choices are "fp32", "fp16" and
+                "bf16". Defaults to "fp32".
+            tokens_per_batch (int, optional): If set, examples of similar lengths
+                are batched together, with at most this number of tokens in each
+                batch, and `batch_size` is ignored. The lengths are estimated
+                from the number of words before tokenization. Defaults to None.
+            grad_compression (str, optional): Compression of the gradients
+                all-reduced in distributed training, one of "none", "fp16" and
+                "powersgd". It helps on clusters with slow interconnects.
+                Defaults to "none".
+            compile_model (bool, optional): Whether to compile the model with
+                `torch.compile` (PyTorch 2.0 or later) to fuse its kernels. The
+                batches are padded to `max_pos_length` tokens so that a single
+                graph is compiled, unless `tokens_per_batch` is set, in which
+                case the graph is compiled for dynamic shapes. Defaults to False.
+            gradient_checkpointing (bool, optional): Whether to recompute the
+                activations of the pretrained transformer in the backward pass,
+                which trades extra compute for much less activation memory and
+                allows larger batches. Defaults to False.
+            cuda_graphs (bool, optional): Whether to replay the forward and
+                backward passes of the model with CUDA graphs, recorded by
+                `torch.compile` after a few warmup steps, which removes most of
+                the kernel launch overhead. The batches are padded to
+                `max_pos_length` tokens and incomplete batches are dropped, so
+                that every step has the same shape. It can't be used with
+                `tokens_per_batch` or `use_preprocessed_data`. Defaults to False.
         """
 
+        if precision not in ["fp32", "fp16", "bf16"]:
+            raise ValueError("Precision not supported: {}".format(precision))
+        if cuda_graphs and (tokens_per_batch or use_preprocessed_data):
+            raise ValueError("CUDA graphs need batches of a fixed size")
+        if (compile_model or cuda_graphs) and not hasattr(torch, "compile"):
+            raise ValueError("torch.compile needs PyTorch 2.0 or later")
+
         # get device
         device, num_gpus = get_device(
             num_gpus=num_gpus, gpu_ids=gpu_ids, local_rank=local_rank
         )
         # move model
         self.model = move_model_to_device(model=self.model, device=device)
+        if gradient_checkpointing:
+            self.model.gradient_checkpointing_enable()
 
         # init optimizer
         optimizer = model_builder.build_optim(
@@ -715,13 +815,39 @@ class ExtractiveSummarizer(Transformer):
             decay_method,
             warmup_steps,
         )
+        ddp_kwargs = {"bucket_cap_mb": bucket_cap_mb}
+        # only supported from PyTorch 1.7 and 1.11
+        ddp_args = inspect.signature(
+            torch.nn.parallel.DistributedDataParallel.__init__
+        ).parameters
+        for name in ["gradient_as_bucket_view", "static_graph"]:
+            if name in ddp_args:
+                ddp_kwargs[name] = True
         self.model = parallelize_model(
             model=self.model,
             device=device,
             num_gpus=num_gpus,
             gpu_ids=gpu_ids,
             local_rank=local_rank,
+            ddp_kwargs=ddp_kwargs,
         )
+        self.model = register_gradient_compression(self.model, grad_compression)
+        # the compiled model is only used for training, the eager one is kept
+        # for saving and prediction
+        eager_model = self.model
+        # compiled graphs are specialized to the input shapes, the batches are
+        # padded to fixed widths unless they are bucketed by length
+        fixed_width = (
+            (compile_model or cuda_graphs)
+            and not tokens_per_batch
+            and not use_preprocessed_data
+        )
+        if compile_model or cuda_graphs:
+            # both modes replay the compiled graphs with CUDA graphs,
+            # "max-autotune" also tunes the kernels
+            mode = "max-autotune" if compile_model else "reduce-overhead"
+            compile_kwargs = {"dynamic": False} if fixed_width else {}
+            self.model = torch.compile(self.model, mode=mode, **compile_kwargs)
 
         # batch_size is the number of tokens in a batch
         if use_preprocessed_data:
@@ -734,24 +860,82 @@ class ExtractiveSummarizer(Transformer):
                 local_rank=local_rank,
             )
         else:
-            if local_rank == -1:
-                sampler = RandomSampler(train_dataset)
+            is_encoded = isinstance(train_dataset, ExtSumEncodedDataset)
+            if tokens_per_batch:
+                if is_encoded:
+                    lengths = train_dataset.lengths()
+                else:
+                    # each sentence is followed by [SEP] [CLS] in the input
+                    lengths = [
+                        min(sum(len(s) + 2 for s in d["src"]), self.max_pos_length)
+                        for d in train_dataset
+                    ]
+                batch_sampler = LengthBucketBatchSampler(
+                    lengths,
+                    tokens_per_batch,
+                    num_replicas=world_size if local_rank != -1 else 1,
+                    rank=rank if local_rank != -1 else 0,
+                    seed=seed if seed is not None else 0,
+                )
+                sampler_kwargs = {"batch_sampler": batch_sampler}
+            elif local_rank == -1:
+                sampler_kwargs = {
+                    "sampler": RandomSampler(train_dataset),
+                    "batch_size": batch_size,
+                    "drop_last": cuda_graphs,
+                }
             else:
-                sampler = DistributedSampler(
-                    train_dataset, num_replicas=world_size, rank=rank
+                sampler_kwargs = {
+                    "sampler": DistributedSampler(
+                        train_dataset, num_replicas=world_size, rank=rank
+                    ),
+                    "batch_size": batch_size,
+                    "drop_last": cuda_graphs,
+                }
+
+            # batches are collated on the host, possibly in worker processes,
+            # and moved to the device in get_inputs
+            batch_widths = {}
+            if fixed_width:
+                batch_widths = _fixed_batch_widths(
+                    self.max_pos_length, self.processor.max_nsents
                 )
 
             def collate_fn(data):
+                if is_encoded:
+                    return Batch(data, is_labeled=True, **batch_widths)
                 return self.processor.collate(
-                    data, block_size=self.max_pos_length, device=device
+                    data,
+                    block_size=self.max_pos_length,
+                    device=torch.device("cpu"),
+                    fixed_width=fixed_width,
                 )
 
+            worker_kwargs = {}
+            if num_workers > 0:
+                worker_kwargs = {"worker_init_fn": _seed_worker}
+                # only supported from PyTorch 1.7
+                loader_args = inspect.signature(DataLoader.__init__).parameters
+                if "prefetch_factor" in loader_args:
+                    worker_kwargs["prefetch_factor"] = prefetch_factor
+                if "persistent_workers" in loader_args:
+                    worker_kwargs["persistent_workers"] = persistent_workers
+
             train_dataloader = DataLoader(
                 train_dataset,
-                sampler=sampler,
-                batch_size=batch_size,
                 collate_fn=collate_fn,
+                num_workers=num_workers,
+                **sampler_kwargs,
+                **worker_kwargs,
             )
+            if pin_memory and device.type == "cuda":
+                # buffers large enough for the batches of the default sampler
+                buffer_ring = PinnedBufferRing(
+                    capacity=tokens_per_batch or batch_size * self.max_pos_length
+                )
+                train_dataloader = DevicePrefetchLoader(
+                    train_dataloader, device, buffer_ring
+                )
 
         # compute the max number of training steps
         max_steps = compute_training_steps(
@@ -760,22 +944,26 @@ class ExtractiveSummarizer(Transformer):
             gradient_accumulation_steps=gradient_accumulation_steps,
         )
 
-        super().fine_tune(
-            train_dataloader=train_dataloader,
-            get_inputs=ExtSumProcessor.get_inputs,
-            device=device,
-            num_gpus=num_gpus,
-            max_steps=max_steps,
-            max_grad_norm=max_grad_norm,
-            gradient_accumulation_steps=gradient_accumulation_steps,
-            optimizer=optimizer,
-            scheduler=None,
-            verbose=verbose,
-            seed=seed,
-            report_every=report_every,
-            clip_grad_norm=False,
-            save_every=save_every,
-        )
+        try:
+            super().fine_tune(
+                train_dataloader=train_dataloader,
+                get_inputs=ExtSumProcessor.get_inputs,
+                device=device,
+                num_gpus=num_gpus,
+                max_steps=max_steps,
+                max_grad_norm=max_grad_norm,
+                gradient_accumulation_steps=gradient_accumulation_steps,
+                optimizer=optimizer,
+                scheduler=None,
+                verbose=verbose,
+                seed=seed,
+                report_every=report_every,
+                clip_grad_norm=False,
+                save_every=save_every,
+                precision=precision,
+            )
+        finally:
+            self.model = eager_model
 
     def predict(
         self,
@@ -833,9 +1021,13 @@ class ExtractiveSummarizer(Transformer):
             batch = Batch(tuple_batch, is_labeled=False)
             return batch
 
+        # batches are copied to the device by prefetch_to_device in predict_scores
         def collate(data):
             return self.processor.collate(
-                data, block_size=self.max_pos_length, train_mode=False, device=device
+                data,
+                block_size=self.max_pos_length,
+                train_mode=False,
+                device=torch.device("cpu"),
             )
 
         if len(test_dataset) == 0:
@@ -898,9 +1090,10 @@ class ExtractiveSummarizer(Transformer):
             1darray: numpy array of predicted sentence scores.
         """
 
+        device, _ = get_device(num_gpus=num_gpus, gpu_ids=gpu_ids, local_rank=-1)
         preds = list(
             super().predict(
-                eval_dataloader=test_dataloader,
+                eval_dataloader=prefetch_to_device(test_dataloader, device),
                 get_inputs=ExtSumProcessor.get_inputs,
                 num_gpus=num_gpus,
                 gpu_ids=gpu_ids,
@@ -918,8 +1111,10 @@ class ExtractiveSummarizer(Transformer):
                 If it's None, the model is going to be saved under "fine_tuned"
                 folder of the cached directory of the object. Defaults to None.
         """
+        # checkpoints saved while training with a compiled model
+        model_to_save = getattr(self.model, "_orig_mod", self.model)
         model_to_save = (
-            self.model.module if hasattr(self.model, "module") else self.model
+            model_to_save.module if hasattr(model_to_save, "module") else model_to_save
         )  # Take care of distributed/parallel training
 
         if full_name is None: